@@ -1,5 +1,5 @@
-import os, json, secrets, logging
-from datetime import datetime, timedelta
+import os, json, secrets, logging, asyncio, signal, time, functools
+from datetime import datetime, timedelta, timezone
 from typing import Optional
 from zoneinfo import ZoneInfo
 
@@ -10,6 +10,7 @@ from dotenv import load_dotenv
 from telegram import (
     Update, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
 )
+from telegram.error import Forbidden, BadRequest, RetryAfter, NetworkError
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
     ContextTypes, filters
@@ -19,6 +20,9 @@ import logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
 log = logging.getLogger("cashier")
 
+# момент старта процесса — для замера времени перезапуска
+STARTED_AT = time.monotonic()
+
 async def safe_edit(q, text: str, **kwargs):
     """
     Универсальное редактирование: если сообщение медиа — меняем caption,
@@ -86,6 +90,20 @@ PROMO_PRICES = {
 PROMO_END_ISO = os.getenv("PROMO_END_ISO", "").strip()  # напр. 2025-08-18T00:00:00+03:00
 TIMEZONE      = os.getenv("TIMEZONE", "Europe/Moscow")
 
+# общий бюджет (сек) на остановку после SIGTERM: ожидание обработчиков,
+# прерывание рассылок и app.stop(); должен быть меньше grace-периода платформы
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "20"))
+# доля бюджета на спокойное ожидание обработчиков, остаток — на прерывание и stop()
+SHUTDOWN_DRAIN_SHARE = 0.75
+
+# outbox: на сколько строка «захватывается» отправителем и как часто повторяем недоставленное
+OUTBOX_LEASE_SEC = int(os.getenv("OUTBOX_LEASE_SEC", "300"))
+OUTBOX_RETRY_SEC = int(os.getenv("OUTBOX_RETRY_SEC", "60"))
+# после стольких сетевых ошибок подряд строка уходит в outbox_failed
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "30"))
+# темп отправки из outbox (сообщений в секунду) — ниже флуд-лимита Telegram
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", "20"))
+
 if not (BOT_TOKEN and ADMIN_ID and DATABASE_URL and POLICY_URL and OFFER_URL and ADS_CONSENT_URL):
     raise RuntimeError("Проверь .env: CASHIER_BOT_TOKEN, ADMIN_ID, DATABASE_URL, POLICY_URL, OFFER_URL, ADS_CONSENT_URL")
 
@@ -141,6 +159,35 @@ cur.execute("""CREATE TABLE IF NOT EXISTS invoice_requests(
   requested_at TIMESTAMPTZ NOT NULL DEFAULT now(),
   closed BOOLEAN NOT NULL DEFAULT FALSE
 );""")
+# исходящие сообщения, которые ещё не доставлены (переживают перезапуск)
+cur.execute("""CREATE TABLE IF NOT EXISTS outbox(
+  id BIGSERIAL PRIMARY KEY,
+  chat_id BIGINT NOT NULL,
+  payload JSONB NOT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  locked_until TIMESTAMPTZ NULL,
+  attempts INT NOT NULL DEFAULT 0
+);""")
+# захват строки отправителем (чтобы два экземпляра не слали одно и то же)
+cur.execute("ALTER TABLE outbox ADD COLUMN IF NOT EXISTS locked_until TIMESTAMPTZ NULL;")
+cur.execute("ALTER TABLE outbox ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0;")
+# сообщения, которые не удалось отправить из-за ошибки, не связанной с сетью
+# (или исчерпавшие попытки), — для ручного разбора
+cur.execute("""CREATE TABLE IF NOT EXISTS outbox_failed(
+  id BIGINT PRIMARY KEY,
+  chat_id BIGINT NOT NULL,
+  payload JSONB NOT NULL,
+  created_at TIMESTAMPTZ NOT NULL,
+  attempts INT NOT NULL,
+  error TEXT NOT NULL,
+  failed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);""")
+# запланированные напоминания о неоплаченных заказах (переживают перезапуск)
+cur.execute("""CREATE TABLE IF NOT EXISTS pending_reminders(
+  order_id BIGINT PRIMARY KEY REFERENCES orders(id) ON DELETE CASCADE,
+  user_id BIGINT NOT NULL,
+  run_at TIMESTAMPTZ NOT NULL
+);""")
 
 
 # Каталог базовых цен (без фото-бота)
@@ -187,6 +234,9 @@ def create_order(user_id: int, code: str) -> int:
 
 def set_status(order_id: int, status: str):
     cur.execute("UPDATE orders SET status=%s WHERE id=%s", (status, order_id))
+    if status != "await_receipt":
+        # напоминание о неоплаченном заказе больше не нужно
+        cur.execute("DELETE FROM pending_reminders WHERE order_id=%s", (order_id,))
 
 def get_order(order_id: int) -> Optional[dict]:
     cur.execute("SELECT * FROM orders WHERE id=%s", (order_id,))
@@ -253,10 +303,6 @@ async def send_examples_screens(ctx, chat_id: int):
             log.warning("send_media_group error: %s", e)
 
 # ----- Напоминания об окончании акции (T-48/T-24) -----
-def get_audience_user_ids() -> list[int]:
-    cur.execute("SELECT user_id FROM consents")
-    return [r["user_id"] for r in cur.fetchall()]
-
 async def job_promo_countdown(ctx: ContextTypes.DEFAULT_TYPE):
     hours_left = ctx.job.data
     if hours_left == 48:
@@ -265,12 +311,320 @@ async def job_promo_countdown(ctx: ContextTypes.DEFAULT_TYPE):
         text = "⏰ Через сутки спеццены закончатся. Последний шанс купить выгодно."
     else:
         text = f"⏰ Напоминание: осталось ~{hours_left} часов до окончания акции."
-    kb = shop_keyboard()
-    for uid in get_audience_user_ids():
+    # вся рассылка одним INSERT ложится в outbox — если нас остановят посреди цикла,
+    # недоставленное отправит следующий экземпляр
+    queued = outbox_enqueue_audience(text, keyboard="shop", parse_mode="HTML")
+    sent = await flush_outbox(ctx.bot)
+    log.info("Рассылка T-%sh: в очереди %d, отправлено %d", hours_left, queued, sent)
+
+async def job_remind_unpaid(ctx: ContextTypes.DEFAULT_TYPE):
+    order_id = ctx.job.data["order_id"]
+    # DELETE ... RETURNING — атомарный захват: при перекрытии экземпляров
+    # напоминание отправит только тот, кто удалил строку; само сообщение
+    # в той же транзакции ложится в outbox и переживает временные ошибки
+    row = None
+    with conn.transaction():
+        cur.execute("DELETE FROM pending_reminders WHERE order_id=%s RETURNING user_id", (order_id,))
+        claimed = cur.fetchone()
+        if not claimed:
+            # уже отработало на другом экземпляре или заказ ушёл из await_receipt
+            return
+        order = get_order(order_id)
+        if order and order["status"] == "await_receipt":
+            row = outbox_put(
+                claimed["user_id"],
+                "⏰ Напоминание: вы оформили заказ, но ещё не прикрепили чек.\n"
+                "Пожалуйста, завершите оплату, чтобы получить доступ к боту."
+            )
+    if row:
+        await deliver_outbox_row(ctx.bot, row)
+
+async def job_outbox_retry(ctx: ContextTypes.DEFAULT_TYPE):
+    sent = await flush_outbox(ctx.bot)
+    if sent:
+        log.info("outbox: дослано %d сообщений", sent)
+
+# -------------------- Lifecycle --------------------
+# Недоставленные сообщения живут в таблице outbox, запланированные напоминания —
+# в pending_reminders; обе пишутся заранее, а не при остановке, поэтому
+# переживают и SIGKILL. При SIGTERM перестаём брать апдейты и укладываем
+# ожидание обработчиков, прерывание рассылок и app.stop() в SHUTDOWN_TIMEOUT.
+
+DRAIN_EXPIRED = asyncio.Event()   # выставляется, когда время на остановку вышло
+_inflight = 0
+_idle = asyncio.Event()
+_idle.set()
+
+OUTBOX_KEYBOARDS = {"shop": shop_keyboard}
+OUTBOX_BATCH = 50
+_next_send_at = 0.0   # time.monotonic(), раньше которого следующая отправка из outbox не уходит
+
+def tracked(fn):
+    """Учитывает выполняющиеся обработчики/задачи, чтобы дождаться их при остановке."""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        global _inflight
+        _inflight += 1
+        _idle.clear()
         try:
-            await ctx.bot.send_message(uid, text, reply_markup=kb, parse_mode="HTML")
+            return await fn(*args, **kwargs)
+        finally:
+            _inflight -= 1
+            if _inflight == 0:
+                _idle.set()
+    return wrapper
+
+def outbox_put(chat_id: int, text: str, keyboard: Optional[str] = None, **kwargs) -> dict:
+    """Кладёт сообщение в outbox сразу захваченным текущим экземпляром."""
+    payload = {"text": text, "keyboard": keyboard, **kwargs}
+    cur.execute(
+        """INSERT INTO outbox(chat_id, payload, locked_until)
+           VALUES(%s,%s::jsonb, now() + make_interval(secs => %s)) RETURNING id""",
+        (chat_id, json.dumps(payload), OUTBOX_LEASE_SEC)
+    )
+    return {"id": cur.fetchone()["id"], "chat_id": chat_id, "payload": payload}
+
+def outbox_enqueue_audience(text: str, keyboard: Optional[str] = None, **kwargs) -> int:
+    payload = {"text": text, "keyboard": keyboard, **kwargs}
+    cur.execute(
+        "INSERT INTO outbox(chat_id, payload) SELECT user_id, %s::jsonb FROM consents",
+        (json.dumps(payload),)
+    )
+    return cur.rowcount
+
+def outbox_claim(limit: int) -> list[dict]:
+    cur.execute(
+        """UPDATE outbox SET locked_until = now() + make_interval(secs => %s)
+           WHERE id IN (
+             SELECT id FROM outbox
+             WHERE locked_until IS NULL OR locked_until < now()
+             ORDER BY id LIMIT %s
+             FOR UPDATE SKIP LOCKED
+           )
+           RETURNING id, chat_id, payload""",
+        (OUTBOX_LEASE_SEC, limit)
+    )
+    return sorted(cur.fetchall(), key=lambda r: r["id"])
+
+def outbox_release(ids: list[int], delay: float = 0):
+    """Снимает захват: строки снова можно отправлять через delay секунд."""
+    if not ids:
+        return
+    cur.execute(
+        "UPDATE outbox SET locked_until = now() + make_interval(secs => %s) WHERE id = ANY(%s)",
+        (delay, ids)
+    )
+
+def outbox_done(outbox_id: int):
+    cur.execute("DELETE FROM outbox WHERE id=%s", (outbox_id,))
+
+def outbox_fail(outbox_id: int, error: str):
+    """Переносит строку в outbox_failed."""
+    cur.execute(
+        """WITH d AS (DELETE FROM outbox WHERE id=%s RETURNING id, chat_id, payload, created_at, attempts)
+           INSERT INTO outbox_failed(id, chat_id, payload, created_at, attempts, error)
+           SELECT id, chat_id, payload, created_at, attempts, %s FROM d
+           ON CONFLICT (id) DO NOTHING""",
+        (outbox_id, error)
+    )
+
+def outbox_retry_later(outbox_id: int, delay: float) -> int:
+    """Учитывает неудачную попытку и откладывает строку; возвращает число попыток."""
+    cur.execute(
+        """UPDATE outbox SET attempts = attempts + 1, locked_until = now() + make_interval(secs => %s)
+           WHERE id=%s RETURNING attempts""",
+        (delay, outbox_id)
+    )
+    row = cur.fetchone()
+    return row["attempts"] if row else 0
+
+def outbox_count() -> int:
+    cur.execute("SELECT count(*) AS n FROM outbox")
+    return cur.fetchone()["n"]
+
+async def pace():
+    """Держит общий темп отправки из outbox не выше OUTBOX_RATE сообщений в секунду."""
+    global _next_send_at
+    now = time.monotonic()
+    wait = _next_send_at - now
+    _next_send_at = max(now, _next_send_at) + 1 / OUTBOX_RATE
+    if wait > 0:
+        await asyncio.sleep(wait)
+
+async def send_outbox_row(bot, row: dict):
+    p = dict(row["payload"])
+    keyboard = p.pop("keyboard", None)
+    text = p.pop("text")
+    kb = OUTBOX_KEYBOARDS[keyboard]() if keyboard else None
+    return await bot.send_message(chat_id=row["chat_id"], text=text, reply_markup=kb, **p)
+
+async def deliver_outbox_row(bot, row: dict) -> tuple[str, float]:
+    """
+    Отправляет захваченную строку outbox. Возвращает (статус, через сколько секунд повтор):
+    "sent" — доставлено; "dropped" — ошибка самой строки, она удалена или
+    перенесена в outbox_failed; "queued" — сетевая ошибка, строка оставлена на повтор;
+    "flood" — флуд-лимит, повтор через retry_after.
+    """
+    await pace()
+    try:
+        await send_outbox_row(bot, row)
+    except (Forbidden, BadRequest) as e:
+        # BadRequest — подкласс NetworkError, поэтому ловим раньше
+        log.warning("outbox #%s: %s не принимает сообщение, удаляем: %s", row["id"], row["chat_id"], e)
+        outbox_done(row["id"])
+        return "dropped", 0
+    except RetryAfter as e:
+        log.warning("outbox #%s: флуд-лимит, повтор через %s с", row["id"], e.retry_after)
+        outbox_release([row["id"]], delay=e.retry_after)
+        return "flood", e.retry_after
+    except NetworkError as e:
+        attempts = outbox_retry_later(row["id"], OUTBOX_RETRY_SEC)
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            log.error("outbox #%s: %d сетевых ошибок подряд, переносим в outbox_failed: %s", row["id"], attempts, e)
+            outbox_fail(row["id"], f"{type(e).__name__}: {e}")
+            return "dropped", 0
+        log.warning("outbox #%s: сетевая ошибка (попытка %d), повтор через %d с: %s",
+                    row["id"], attempts, OUTBOX_RETRY_SEC, e)
+        return "queued", OUTBOX_RETRY_SEC
+    except Exception as e:
+        # ошибка самой строки (устаревший payload, ChatMigrated и т.п.) — повтор не поможет
+        log.exception("outbox #%s: не удалось отправить в %s, переносим в outbox_failed", row["id"], row["chat_id"])
+        outbox_fail(row["id"], f"{type(e).__name__}: {e}")
+        return "dropped", 0
+    outbox_done(row["id"])
+    return "sent", 0
+
+async def wait_unless_stopping(seconds: float) -> bool:
+    """Спит seconds; False — если за это время началось прерывание рассылок."""
+    try:
+        await asyncio.wait_for(DRAIN_EXPIRED.wait(), seconds)
+        return False
+    except asyncio.TimeoutError:
+        return True
+
+async def flush_outbox(bot) -> int:
+    """Досылает всё, что можно захватить в outbox; при остановке возвращает остаток в очередь."""
+    sent = 0
+    while not DRAIN_EXPIRED.is_set():
+        rows = outbox_claim(OUTBOX_BATCH)
+        if not rows:
+            break
+        for i, row in enumerate(rows):
+            if DRAIN_EXPIRED.is_set():
+                rest = [r["id"] for r in rows[i:]]
+                outbox_release(rest)
+                log.info("Рассылка прервана остановкой, %d сообщений возвращено в outbox", len(rest))
+                return sent
+            status, delay = await deliver_outbox_row(bot, row)
+            if status == "sent":
+                sent += 1
+            elif status == "flood":
+                # Telegram просит подождать — ждём и продолжаем с того же места
+                outbox_release([r["id"] for r in rows[i + 1:]], delay=delay)
+                if not await wait_unless_stopping(delay + 1):
+                    return sent
+                break
+            elif status == "queued":
+                # сеть недоступна — остальное попробует job_outbox_retry
+                outbox_release([r["id"] for r in rows[i + 1:]], delay=delay)
+                return sent
+    return sent
+
+def schedule_reminder(job_queue, order_id: int, user_id: int, run_at: datetime):
+    job_queue.run_once(
+        tracked(job_remind_unpaid), when=run_at,
+        data={"order_id": order_id, "user_id": user_id}, name=f"remind_order_{order_id}"
+    )
+
+def add_reminder(job_queue, order_id: int, user_id: int, delay_sec: int):
+    run_at = datetime.now(timezone.utc) + timedelta(seconds=delay_sec)
+    cur.execute(
+        """INSERT INTO pending_reminders(order_id, user_id, run_at) VALUES(%s,%s,%s)
+           ON CONFLICT (order_id) DO UPDATE SET user_id=EXCLUDED.user_id, run_at=EXCLUDED.run_at""",
+        (order_id, user_id, run_at)
+    )
+    schedule_reminder(job_queue, order_id, user_id, run_at)
+
+def resume_reminders(app: Application) -> int:
+    cur.execute("SELECT order_id, user_id, run_at FROM pending_reminders")
+    rows = cur.fetchall()
+    now = datetime.now(timezone.utc)
+    for r in rows:
+        schedule_reminder(app.job_queue, r["order_id"], r["user_id"], max(r["run_at"], now))
+    return len(rows)
+
+async def drain(timeout: float) -> bool:
+    """Ждёт завершения текущих обработчиков; False — если не уложились в timeout."""
+    if _idle.is_set():
+        return True
+    try:
+        await asyncio.wait_for(_idle.wait(), max(timeout, 0))
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+async def stop_app(app: Application, deadline: float):
+    """Останавливает приём апдейтов, ждёт обработчики и app.stop() — всё до deadline (time.monotonic)."""
+    if app.updater.running:
+        try:
+            await asyncio.wait_for(app.updater.stop(), max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            log.warning("updater.stop() не уложился в SHUTDOWN_TIMEOUT, продолжаем остановку")
+
+    reserve = SHUTDOWN_TIMEOUT * (1 - SHUTDOWN_DRAIN_SHARE)
+    drained = await drain(deadline - reserve - time.monotonic())
+    if not drained:
+        log.warning("Обработчики не завершились вовремя (%d), прерываем рассылки", _inflight)
+        DRAIN_EXPIRED.set()
+        # половину резерва даём прерванным рассылкам вернуть строки в outbox
+        drained = await drain((deadline - time.monotonic()) / 2)
+    if drained:
+        log.info("Ожидание обработчиков завершено")
+    else:
+        log.warning("Ожидание обработчиков НЕ завершено, выполняется: %d", _inflight)
+
+    if app.running:
+        try:
+            await asyncio.wait_for(app.stop(), max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            log.warning("app.stop() не уложился в SHUTDOWN_TIMEOUT, прерываем")
+
+async def run(app: Application):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    stop_started = None
+    try:
+        async with app:
+            reminders = resume_reminders(app)
+            pending = outbox_count()
+            # первый прогон сразу — досылаем то, что осталось от прошлого экземпляра
+            app.job_queue.run_repeating(tracked(job_outbox_retry), interval=OUTBOX_RETRY_SEC,
+                                        first=0, name="outbox_retry")
+            await app.start()
+            try:
+                await app.updater.start_polling()
+                log.info("Бот запущен за %.2f с (в outbox: %d сообщений, напоминаний: %d)",
+                         time.monotonic() - STARTED_AT, pending, reminders)
+                await stop.wait()
+                stop_started = time.monotonic()
+                log.info("Получен сигнал остановки, перестаём принимать апдейты")
+            finally:
+                if stop_started is None:
+                    stop_started = time.monotonic()
+                await stop_app(app, stop_started + SHUTDOWN_TIMEOUT)
+    finally:
+        if stop_started is None:
+            stop_started = time.monotonic()
+        left = None
+        try:
+            left = outbox_count()
         except Exception:
-            pass
+            log.exception("Не удалось посчитать outbox при остановке")
+        conn.close()
+        log.info("Остановка завершена за %.2f с (в outbox: %s)", time.monotonic() - stop_started, left)
 
 # -------------------- Handlers --------------------
 async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -397,24 +751,7 @@ async def cb(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                 parse_mode="HTML"
             )
 
-            async def remind_unpaid(context: ContextTypes.DEFAULT_TYPE):
-                cur.execute(
-                    "SELECT status FROM orders WHERE id=%s", (order_id,)
-                )
-                row = cur.fetchone()
-                if row and row["status"] == "await_receipt":
-                    try:
-                        await context.bot.send_message(
-                            chat_id=uid,
-                            text=(
-                                "⏰ Напоминание: вы оформили заказ, но ещё не прикрепили чек.\n"
-                                "Пожалуйста, завершите оплату, чтобы получить доступ к боту."
-                            )
-                        )
-                    except Exception:
-                        pass
-
-            ctx.job_queue.run_once(remind_unpaid, when=3600, name=f"remind_order_{order_id}")
+            add_reminder(ctx.job_queue, order_id, uid, 3600)
             return
 
         if data.startswith("send_receipt:"):
@@ -441,40 +778,40 @@ async def cb(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                 await q.edit_message_text(f"⚠️ Заказ #{order_id} не найден в базе.")
                 return
 
-            # 2. Меняем статус на "оплачено"
-            set_status(order_id, "paid")
-            
-            # 3. Получаем информацию о купленном продукте
+            # 2. Получаем информацию о купленном продукте
             product = get_product(order["product_code"])
             if not product:
                 await q.edit_message_text(f"⚠️ Продукт '{order['product_code']}' для заказа #{order_id} не найден.")
                 return
 
-            # 4. Генерируем уникальные ссылки доступа
+            # 3. Генерируем уникальные ссылки доступа
             user_id = order["user_id"]
             targets = product["targets"] # Список ботов, например ['jtbd_assistant_bot']
             links = gen_tokens_with_ttl(user_id, targets, TOKEN_TTL_HOURS)
 
-            # 5. Формируем и отправляем сообщение пользователю со ссылками
             link_lines = "\n".join([f"➡️ <a href='{link}'>{bot_name}</a>" for bot_name, link in links])
-            
-            try:
-                await ctx.bot.send_message(
-                    chat_id=user_id,
-                    text=(
-                        "✅ Оплата подтверждена!\n\n"
-                        "Вот ваши персональные ссылки для доступа к ботам:\n\n"
-                        f"{link_lines}\n\n"
-                        f"⚠️ <b>Важно:</b> Ссылки действительны в течение {TOKEN_TTL_HOURS} часов. "
-                        "Обязательно перейдите по ним и запустите ботов, чтобы доступ сохранился навсегда."
-                    ),
-                    parse_mode="HTML",
-                    disable_web_page_preview=True
-                )
-                # 6. Сообщаем админу, что всё прошло успешно
+            text = (
+                "✅ Оплата подтверждена!\n\n"
+                "Вот ваши персональные ссылки для доступа к ботам:\n\n"
+                f"{link_lines}\n\n"
+                f"⚠️ <b>Важно:</b> Ссылки действительны в течение {TOKEN_TTL_HOURS} часов. "
+                "Обязательно перейдите по ним и запустите ботов, чтобы доступ сохранился навсегда."
+            )
+
+            # 4. Статус "оплачено" и сообщение со ссылками в outbox — одной транзакцией:
+            # если процесс умрёт после коммита, ссылки дошлёт следующий экземпляр
+            with conn.transaction():
+                set_status(order_id, "paid")
+                row = outbox_put(user_id, text, parse_mode="HTML", disable_web_page_preview=True)
+
+            # 5. Отправляем и сообщаем админу результат
+            status, _ = await deliver_outbox_row(ctx.bot, row)
+            if status == "sent":
                 await q.edit_message_caption(caption=f"✅ Доступ по заказу #{order_id} успешно выдан пользователю {user_id}.")
-            except Exception as e:
-                log.error(f"Не удалось отправить ссылки пользователю {user_id} по заказу #{order_id}: {e}")
+            elif status in ("queued", "flood"):
+                await q.edit_message_caption(caption=f"⏳ Заказ #{order_id} оплачен, но ссылки пользователю {user_id} сейчас не ушли. Доставка поставлена в очередь на повтор.")
+            else:
+                log.error(f"Не удалось отправить ссылки пользователю {user_id} по заказу #{order_id}")
                 await q.edit_message_caption(caption=f"❌ Ошибка при выдаче доступа по заказу #{order_id}. Пользователю {user_id} не удалось отправить сообщение. Проверьте логи.")
             
             return
@@ -616,23 +953,23 @@ def main():
     app = Application.builder().token(BOT_TOKEN).build()
 
     # Регистрация обработчиков
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("vnote", help_vnote))
-    app.add_handler(CommandHandler("photoid", cmd_photoid))
-    app.add_handler(CallbackQueryHandler(cb))
+    app.add_handler(CommandHandler("start", tracked(start)))
+    app.add_handler(CommandHandler("vnote", tracked(help_vnote)))
+    app.add_handler(CommandHandler("photoid", tracked(cmd_photoid)))
+    app.add_handler(CallbackQueryHandler(tracked(cb)))
     
     # Обработчики сообщений
     # Важно: admin_invoice_upload должен быть проверен до receipts, если админ шлёт файл
     app.add_handler(MessageHandler(
         (filters.PHOTO | filters.Document.ALL) & filters.User(ADMIN_ID) & ~filters.COMMAND, 
-        admin_invoice_upload
+        tracked(admin_invoice_upload)
     ))
     app.add_handler(MessageHandler(
         (filters.PHOTO | filters.Document.ALL) & ~filters.User(ADMIN_ID) & ~filters.COMMAND, 
-        receipts
+        tracked(receipts)
     ))
-    app.add_handler(MessageHandler(filters.VIDEO_NOTE & filters.User(ADMIN_ID) & ~filters.COMMAND, detect_vnote))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, fallback))
+    app.add_handler(MessageHandler(filters.VIDEO_NOTE & filters.User(ADMIN_ID) & ~filters.COMMAND, tracked(detect_vnote)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, tracked(fallback)))
 
     # Запуск задач по расписанию (напоминания об акции)
     if PROMO_END_ISO:
@@ -648,19 +985,19 @@ def main():
             t_minus_24 = promo_end - timedelta(hours=24)
 
             if t_minus_48 > now:
-                app.job_queue.run_once(job_promo_countdown, when=t_minus_48, data=48, name="promo_Tminus48h")
+                app.job_queue.run_once(tracked(job_promo_countdown), when=t_minus_48, data=48, name="promo_Tminus48h")
                 log.info("Запланировано напоминание T-48h на %s", t_minus_48.isoformat())
 
             if t_minus_24 > now:
-                app.job_queue.run_once(job_promo_countdown, when=t_minus_24, data=24, name="promo_Tminus24h")
+                app.job_queue.run_once(tracked(job_promo_countdown), when=t_minus_24, data=24, name="promo_Tminus24h")
                 log.info("Запланировано напоминание T-24h на %s", t_minus_24.isoformat())
 
         except Exception as e:
             log.warning("Ошибка планирования напоминаний об акции: %s", e)
 
-    # Запуск бота
+    # Запуск бота (со своей обработкой SIGTERM — см. run)
     log.info("Бот запускается...")
-    app.run_polling()
+    asyncio.run(run(app))
 
 
 if __name__ == "__main__":